@@ -6,10 +6,22 @@ import sqlite3
 import shutil
 import random
 import math
+import heapq
+import hashlib
+import json
+import re
+import threading
+import time
+import statistics
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import dataclasses
 from dataclasses import dataclass
 from typing import Dict, List, Set
 
+def info(msg):
+    when = str(dt.datetime.now())
+    print(f"INFO - {when} - {msg}", file=sys.stderr)
 
 @dataclass
 class CumFreqRow:
@@ -30,14 +42,69 @@ class CumFreqTable:
         row = CumFreqRow(value, self.maxcumfreq)
         self.rows.append(row)
     
-    def pick(self):
-        pick_cumfreq = random.randint(0, self.maxcumfreq)
+    def pick(self, rng):
+        pick_cumfreq = rng.randint(0, self.maxcumfreq)
         pick = self.rows[0]
         for row in self.rows:
             if row.cumfreq > pick_cumfreq:
                 break
             pick = row
         return pick.value
+
+@dataclass
+class AliasTable:
+    values  : List[object]
+    probs   : List[float]
+    aliases : List[int]
+    
+    # Vose's alias method: O(n) to build, O(1) per draw
+    @classmethod
+    def new(klass, values, weights):
+        n = len(values)
+        assert n > 0 and n == len(weights)
+        total = sum(weights)
+        scaled = [ w * n / total for w in weights ]
+        probs = [ 1.0 ] * n
+        aliases = list(range(n))
+        small = [ i for i, p in enumerate(scaled) if p < 1.0 ]
+        large = [ i for i, p in enumerate(scaled) if p >= 1.0 ]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            probs[s] = scaled[s]
+            aliases[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        return klass(values=list(values), probs=probs, aliases=aliases)
+    
+    def pick_many(self, rng, count):
+        n = len(self.values)
+        values, probs, aliases = self.values, self.probs, self.aliases
+        result = []
+        for _ in range(count):
+            i = rng.randrange(n)
+            result.append(values[i] if rng.random() < probs[i] else values[aliases[i]])
+        return result
+
+class RngStreams(object):
+    
+    # every stream is derived from the seed and its key alone, so draws never depend on the order
+    # in which streams are created or consumed
+    
+    def __init__(self, seed):
+        self.seed = seed
+    
+    @classmethod
+    def random_seed(klass):
+        return random.SystemRandom().randrange(2 ** 63)
+    
+    def stream(self, purpose, *keys):
+        key = repr((self.seed, purpose) + keys).encode('utf-8')
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        return random.Random(int.from_bytes(digest, 'big'))
         
 class Db:
     
@@ -95,6 +162,40 @@ class Db:
         );
     """
     
+    SQL_INSERT_CUSTOMER_WITH_ID = """
+        INSERT INTO customers(
+            CustomerId
+        ,   FirstName
+        ,   LastName
+        ,   Company
+        ,   Address
+        ,   City
+        ,   State
+        ,   Country
+        ,   PostalCode
+        ,   Phone
+        ,   Fax
+        ,   Email
+        ,   SupportRepId
+        ) VALUES (
+            ? -- CustomerId
+        ,   ? -- FirstName
+        ,   ? -- LastName
+        ,   ? -- Company
+        ,   ? -- Address
+        ,   ? -- City
+        ,   ? -- State
+        ,   ? -- Country
+        ,   ? -- PostalCode
+        ,   ? -- Phone
+        ,   ? -- Fax
+        ,   ? -- Email
+        ,   ? -- SupportRepId
+        );
+    """
+    
+    SQL_NEXT_CUSTOMER_ID = "SELECT COALESCE(MAX(CustomerId), 0) + 1 FROM customers;"
+    
     SQL_INSERT_INVOICE = """
         INSERT INTO invoices (
             CustomerId
@@ -121,6 +222,43 @@ class Db:
         UPDATE  invoices SET Total = Total + ? WHERE InvoiceId = ?;
     """
     
+    SQL_CREATE_DAILY_PLAN = """
+        CREATE TABLE IF NOT EXISTS gen_daily_plan (
+            PlanDate        DATE    NOT NULL PRIMARY KEY
+        ,   PlannedInvoices INTEGER NOT NULL
+        ,   CreatedInvoices INTEGER NOT NULL
+        );
+    """
+    
+    SQL_CREATE_CUSTOMER_CHURN = """
+        CREATE TABLE IF NOT EXISTS gen_customer_churn (
+            CustomerId  INTEGER NOT NULL PRIMARY KEY
+        ,   ChurnDate   DATE    NOT NULL
+        );
+    """
+    
+    SQL_INSERT_DAILY_PLAN = """
+        INSERT INTO gen_daily_plan(
+            PlanDate
+        ,   PlannedInvoices
+        ,   CreatedInvoices
+        ) VALUES (
+            ? -- PlanDate
+        ,   ? -- PlannedInvoices
+        ,   ? -- CreatedInvoices
+        );
+    """
+    
+    SQL_INSERT_CUSTOMER_CHURN = """
+        INSERT INTO gen_customer_churn(
+            CustomerId
+        ,   ChurnDate
+        ) VALUES (
+            ? -- CustomerId
+        ,   ? -- ChurnDate
+        );
+    """
+    
     SQL_INSERT_INVOICE_LINE = """
         INSERT INTO invoice_items(
             InvoiceId
@@ -134,8 +272,140 @@ class Db:
         ,   ? -- Quantity
         );
     """
-    def __init__(self, dbfile):
+    
+    SQL_CREATE_LOCATIONS = """
+        CREATE TABLE IF NOT EXISTS locations (
+            LocationId  INTEGER         NOT NULL PRIMARY KEY
+        ,   Address     NVARCHAR(70)
+        ,   City        NVARCHAR(40)
+        ,   State       NVARCHAR(40)
+        ,   Country     NVARCHAR(40)
+        ,   PostalCode  NVARCHAR(10)
+        );
+    """
+    
+    SQL_INSERT_LOCATION = """
+        INSERT OR REPLACE INTO locations(
+            LocationId
+        ,   Address
+        ,   City
+        ,   State
+        ,   Country
+        ,   PostalCode
+        ) VALUES (
+            ? -- LocationId
+        ,   ? -- Address
+        ,   ? -- City
+        ,   ? -- State
+        ,   ? -- Country
+        ,   ? -- PostalCode
+        );
+    """
+    
+    # compatibility views exposing the original chinook columns over the compact tables
+    SQL_CREATE_CUSTOMERS_VIEW = """
+        CREATE VIEW IF NOT EXISTS customers_v AS
+        SELECT  a.CustomerId
+        ,       a.FirstName
+        ,       a.LastName
+        ,       a.Company
+        ,       COALESCE(a.Address,     b.Address)      AS Address
+        ,       COALESCE(a.City,        b.City)         AS City
+        ,       COALESCE(a.State,       b.State)        AS State
+        ,       COALESCE(a.Country,     b.Country)      AS Country
+        ,       COALESCE(a.PostalCode,  b.PostalCode)   AS PostalCode
+        ,       a.Phone
+        ,       a.Fax
+        ,       a.Email
+        ,       a.SupportRepId
+        FROM    customers a
+                --
+                LEFT JOIN locations b
+                ON  a.LocationId = b.LocationId
+                --
+    """
+    
+    SQL_CREATE_INVOICES_VIEW = """
+        CREATE VIEW IF NOT EXISTS invoices_v AS
+        SELECT  a.InvoiceId
+        ,       a.CustomerId
+        ,       a.InvoiceDate
+        ,       COALESCE(a.BillingAddress,      b.Address)      AS BillingAddress
+        ,       COALESCE(a.BillingCity,         b.City)         AS BillingCity
+        ,       COALESCE(a.BillingState,        b.State)        AS BillingState
+        ,       COALESCE(a.BillingCountry,      b.Country)      AS BillingCountry
+        ,       COALESCE(a.BillingPostalCode,   b.PostalCode)   AS BillingPostalCode
+        ,       a.Total
+        FROM    invoices a
+                --
+                LEFT JOIN locations b
+                ON  a.LocationId = b.LocationId
+                --
+    """
+    
+    SQL_INSERT_CUSTOMER_COMPACT = """
+        INSERT INTO customers(
+            FirstName
+        ,   LastName
+        ,   Company
+        ,   LocationId
+        ,   Phone
+        ,   Fax
+        ,   Email
+        ,   SupportRepId
+        ) VALUES (
+            ? -- FirstName
+        ,   ? -- LastName
+        ,   ? -- Company
+        ,   ? -- LocationId
+        ,   ? -- Phone
+        ,   ? -- Fax
+        ,   ? -- Email
+        ,   ? -- SupportRepId
+        );
+    """
+    
+    SQL_INSERT_CUSTOMER_COMPACT_WITH_ID = """
+        INSERT INTO customers(
+            CustomerId
+        ,   FirstName
+        ,   LastName
+        ,   Company
+        ,   LocationId
+        ,   Phone
+        ,   Fax
+        ,   Email
+        ,   SupportRepId
+        ) VALUES (
+            ? -- CustomerId
+        ,   ? -- FirstName
+        ,   ? -- LastName
+        ,   ? -- Company
+        ,   ? -- LocationId
+        ,   ? -- Phone
+        ,   ? -- Fax
+        ,   ? -- Email
+        ,   ? -- SupportRepId
+        );
+    """
+    
+    SQL_INSERT_INVOICE_COMPACT = """
+        INSERT INTO invoices (
+            CustomerId
+        ,   InvoiceDate
+        ,   LocationId
+        ,   Total
+        ) VALUES (
+            ? -- CustomerId
+        ,   ? -- InvoiceDate
+        ,   ? -- LocationId
+        ,   ? -- Total
+        );
+    """
+    
+    def __init__(self, dbfile, compact=False):
         self.dbfile = dbfile
+        self.compact = compact
         self.conn = None
     
     def open(self):
@@ -157,7 +427,41 @@ class Db:
         rows = cursor.fetchall()
         return MusicData.from_rows(rows)
     
+    @staticmethod
+    def invoices_relation(conn):
+        # compact DBs keep billing locations out of the invoices table, so readers go through the view
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'invoices_v'").fetchone()
+        return 'invoices' if row is None else 'invoices_v'
+    
+    def has_column(self, table, column):
+        cursor = self.conn.cursor()
+        columns = [ row[1] for row in cursor.execute(f"PRAGMA table_info({table})") ]
+        del cursor
+        return column in columns
+    
+    def create_compact_schema(self):
+        cursor = self.conn.cursor()
+        cursor.execute(self.SQL_CREATE_LOCATIONS)
+        for i, (location, _) in enumerate(Customer.LOCATIONS):
+            params = (
+                i + 1
+            ,   Customer.DEFAULT_ADDRESS
+            ,   location[Customer.LOCATION_CITY_IDX]
+            ,   location[Customer.LOCATION_STATE_IDX]
+            ,   location[Customer.LOCATION_COUNTRY_IDX]
+            ,   Customer.DEFAULT_POSTAL_CODE
+            )
+            cursor.execute(self.SQL_INSERT_LOCATION, params)
+        for table in ('customers', 'invoices'):
+            if not self.has_column(table, 'LocationId'):
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN LocationId INTEGER REFERENCES locations(LocationId)")
+        cursor.execute(self.SQL_CREATE_CUSTOMERS_VIEW)
+        cursor.execute(self.SQL_CREATE_INVOICES_VIEW)
+        del cursor
+    
     def insert_customer(self, c):
+        if self.compact:
+            return self.insert_customer_compact(c)
         params = (
             c.first_name
         ,   c.last_name
@@ -179,13 +483,61 @@ class Db:
         c.id = row[0]
         del cursor
     
+    def insert_customer_compact(self, c):
+        params = (
+            c.first_name
+        ,   c.last_name
+        ,   c.company
+        ,   c.location_id
+        ,   c.phone
+        ,   c.fax
+        ,   c.email
+        ,   c.support_rep_id
+        )
+        cursor = self.conn.cursor()
+        cursor.execute(self.SQL_INSERT_CUSTOMER_COMPACT, params)
+        cursor.execute(self.SQL_LAST_ROWID)
+        row = cursor.fetchone()
+        c.id = row[0]
+        del cursor
+    
+    def next_customer_id(self):
+        cursor = self.conn.cursor()
+        cursor.execute(self.SQL_NEXT_CUSTOMER_ID)
+        row = cursor.fetchone()
+        del cursor
+        return row[0]
+    
+    def insert_customers_bulk(self, customers):
+        if self.compact:
+            sql = self.SQL_INSERT_CUSTOMER_COMPACT_WITH_ID
+            params = (
+                (c.id, c.first_name, c.last_name, c.company, c.location_id, c.phone, c.fax, c.email, c.support_rep_id)
+                for c in customers
+            )
+        else:
+            sql = self.SQL_INSERT_CUSTOMER_WITH_ID
+            params = (
+                (c.id, c.first_name, c.last_name, c.company, c.address, c.city, c.state, c.country, c.postal_code, c.phone, c.fax, c.email, c.support_rep_id)
+                for c in customers
+            )
+        cursor = self.conn.cursor()
+        cursor.executemany(sql, params)
+        del cursor
+    
     def clear_old_invoices(self):
         cursor = self.conn.cursor()
         cursor.execute("DELETE FROM invoices")
         cursor.execute("DELETE FROM invoice_items")
+        cursor.execute(self.SQL_CREATE_DAILY_PLAN)
+        cursor.execute(self.SQL_CREATE_CUSTOMER_CHURN)
+        cursor.execute("DELETE FROM gen_daily_plan")
+        cursor.execute("DELETE FROM gen_customer_churn")
         del cursor
         
     def insert_invoice(self, i):
+        if self.compact:
+            return self.insert_invoice_compact(i)
         params = (
             i.customer_id
         ,   i.invoice_date
@@ -203,6 +555,20 @@ class Db:
         i.id = row[0]
         del cursor
     
+    def insert_invoice_compact(self, i):
+        params = (
+            i.customer_id
+        ,   i.invoice_date
+        ,   i.location_id
+        ,   i.total
+        )
+        cursor = self.conn.cursor()
+        cursor.execute(self.SQL_INSERT_INVOICE_COMPACT, params)
+        cursor.execute(self.SQL_LAST_ROWID)
+        row = cursor.fetchone()
+        i.id = row[0]
+        del cursor
+    
     def insert_invoice_line(self, il):
         params = (
             il.invoice_id
@@ -217,10 +583,181 @@ class Db:
         il.id = row[0]
         params = (
             il.unit_price * il.quantity
-        ,   il.id
+        ,   il.invoice_id
         )
         cursor.execute(self.SQL_UPDATE_INVOICE_TOTAL, params)
         del cursor
+    
+    def insert_daily_plan(self, date, planned_invoices, created_invoices):
+        params = (
+            date
+        ,   planned_invoices
+        ,   created_invoices
+        )
+        cursor = self.conn.cursor()
+        cursor.execute(self.SQL_INSERT_DAILY_PLAN, params)
+        del cursor
+    
+    def insert_customer_churn(self, customer_id, date):
+        params = (
+            customer_id
+        ,   date
+        )
+        cursor = self.conn.cursor()
+        cursor.execute(self.SQL_INSERT_CUSTOMER_CHURN, params)
+        del cursor
+
+@dataclass
+class TrickleOptions:
+    rate                : float
+    time_compression    : float
+    max_txn_invoices    : int
+    max_txn_ms          : float
+    journal_mode        : str
+    probe_interval      : float
+    
+    JOURNAL_MODES = ('wal', 'delete')
+    
+    def __post_init__(self):
+        assert (self.rate is None) != (self.time_compression is None)
+        assert self.max_txn_invoices > 0
+        assert self.max_txn_ms > 0
+        assert self.journal_mode in self.JOURNAL_MODES
+
+class TrickleDb(Db):
+    
+    # paces invoice inserts to a target rate and keeps write transactions short. Pending work is
+    # always committed before sleeping, so no lock is held while waiting for the next invoice
+    
+    def __init__(self, dbfile, options, compact=False):
+        super().__init__(dbfile, compact)
+        self.options        = options
+        self.interval       = None if options.rate is None else 1.0 / options.rate
+        self.next_due       = None
+        self.txn_invoices   = 0
+        self.txn_start      = None
+        self.max_lag        = 0.0
+        self.commit_times   = []
+        self.txn_sizes      = []
+        self.invoice_count  = 0
+        self.start_time     = None
+    
+    def open(self):
+        super().open()
+        mode, = self.conn.execute(f'PRAGMA journal_mode={self.options.journal_mode}').fetchone()
+        assert mode == self.options.journal_mode
+    
+    def start_day(self, date, num_invoices):
+        if self.options.time_compression is not None:
+            day_seconds = 86400.0 / self.options.time_compression
+            self.interval = day_seconds / max(num_invoices, 1)
+    
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        self.commit_times.append(time.perf_counter() - start)
+        if self.txn_invoices:
+            self.txn_sizes.append(self.txn_invoices)
+        self.txn_invoices = 0
+        self.txn_start = None
+    
+    def pace(self):
+        now = time.perf_counter()
+        if self.next_due is None:
+            self.next_due = now
+            self.start_time = now
+        wait = self.next_due - now
+        if wait > 0:
+            if self.txn_invoices:
+                self.commit()
+            time.sleep(wait)
+        else:
+            self.max_lag = max(self.max_lag, -wait)
+        self.next_due += self.interval
+    
+    def insert_invoice(self, i):
+        self.pace()
+        txn_ms = 0.0 if self.txn_start is None else (time.perf_counter() - self.txn_start) * 1000.0
+        if self.txn_invoices >= self.options.max_txn_invoices or txn_ms >= self.options.max_txn_ms:
+            self.commit()
+        if self.txn_start is None:
+            self.txn_start = time.perf_counter()
+        super().insert_invoice(i)
+        self.txn_invoices += 1
+        self.invoice_count += 1
+    
+    def metrics(self):
+        elapsed = 0.0 if self.start_time is None else time.perf_counter() - self.start_time
+        return {
+            'invoices'          : self.invoice_count
+        ,   'elapsed'           : elapsed
+        ,   'invoices_per_sec'  : self.invoice_count / max(elapsed, 1e-9)
+        ,   'max_lag'           : self.max_lag
+        ,   'commits'           : len(self.commit_times)
+        ,   'commit_ms'         : percentiles(self.commit_times, 1000.0)
+        ,   'txn_invoices'      : percentiles(self.txn_sizes)
+        }
+
+class ReaderProbe(object):
+    
+    # polls the output DB like an incremental extractor and measures how often and how long it is blocked
+    
+    SQL_POLL = """
+        SELECT  InvoiceId
+        ,       Total
+        FROM    invoices
+        WHERE   InvoiceId > ?
+        ORDER   BY InvoiceId
+    """
+    
+    def __init__(self, dbfile, interval):
+        self.dbfile         = dbfile
+        self.interval       = interval
+        self.stop_event     = threading.Event()
+        self.thread         = None
+        self.latencies      = []
+        self.busy_count     = 0
+        self.rows_read      = 0
+        self.last_id        = 0
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+    
+    def loop(self):
+        uri = 'file:' + os.path.abspath(self.dbfile) + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, timeout=0)
+        while not self.stop_event.wait(self.interval):
+            start = time.perf_counter()
+            try:
+                rows = conn.execute(self.SQL_POLL, (self.last_id,)).fetchall()
+            except sqlite3.OperationalError:
+                self.busy_count += 1
+                continue
+            self.latencies.append(time.perf_counter() - start)
+            if rows:
+                self.last_id = rows[-1][0]
+                self.rows_read += len(rows)
+        conn.close()
+    
+    def metrics(self):
+        return {
+            'polls'         : len(self.latencies) + self.busy_count
+        ,   'busy'          : self.busy_count
+        ,   'rows_read'     : self.rows_read
+        ,   'poll_ms'       : percentiles(self.latencies, 1000.0)
+        }
+
+def percentiles(values, scale=1.0):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * scale
+    return { 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': ordered[-1] * scale }
 
 @dataclass 
 class MusicData:
@@ -242,6 +779,75 @@ class MusicData:
             result.append(obj)
         return result
 
+@dataclass
+class Catalog:
+    entries : List[MusicData]
+    states  : Dict[ tuple, "State" ]
+    
+    @classmethod
+    def from_db(klass, db):
+        db.open()
+        entries = db.fetch_music_data()
+        db.close()
+        return klass(entries=entries, states={})
+    
+    def new_state(self, popularity='uniform', zipf_exponent=1.0):
+        # the parsed catalog and its samplers are built once per popularity model and shared by every run
+        key = (popularity, zipf_exponent)
+        template = self.states.get(key)
+        if template is None:
+            template = State.new()
+            for entry in self.entries:
+                template.process_entry(entry)
+            template.fill_genre_cumfreqs(popularity, zipf_exponent)
+            self.states[key] = template
+        return template.copy()
+
+class LazyCustomers(object):
+    
+    # stands in for State.customers: a customer is derived from (seed, index) when first looked up
+    # and only the customers actually picked are kept, together with their churn flag and purchases
+    
+    def __init__(self, state, streams, first_id, count):
+        self.state          = state
+        self.streams        = streams
+        self.first_id       = first_id
+        self.count          = count
+        self.materialized   = {}
+    
+    @property
+    def ids(self):
+        return range(self.first_id, self.first_id + self.count)
+    
+    def derive(self, index):
+        c = Customer.random(self.state, self.streams.stream('customer', index))
+        c.id = self.first_id + index
+        return c
+    
+    def derive_all(self):
+        for index in range(self.count):
+            yield self.derive(index)
+    
+    def get(self, customer_id, default=None):
+        c = self.materialized.get(customer_id)
+        if c is not None:
+            return c
+        index = customer_id - self.first_id
+        if not 0 <= index < self.count:
+            return default
+        c = self.derive(index)
+        self.materialized[customer_id] = c
+        return c
+    
+    def __getitem__(self, customer_id):
+        c = self.get(customer_id)
+        if c is None:
+            raise KeyError(customer_id)
+        return c
+    
+    def __len__(self):
+        return self.count
+
 @dataclass
 class State:
     genres         : Dict[ int, "Genre"    ]
@@ -255,6 +861,9 @@ class State:
     NUM_INVOICE_LINES_MU    = math.log(2)
     NUM_INVOICE_LINES_SIGMA = 0.75
     CHURN_PROB              = 0.00005
+    POPULARITY_MODELS       = ('uniform', 'zipf', 'artist')
+    POPULARITY_SEED         = 0
+    TRACK_REDRAWS           = 10
     
     def __repr__(self):
         return "<State>"
@@ -274,6 +883,10 @@ class State:
         ,   genre_cumfreqs  = CumFreqTable.new()
         )
         
+    def copy(self):
+        # catalog and samplers are read only while generating, so only the customers are per run
+        return dataclasses.replace(self, customers={}, customer_ids=[])
+        
     def get_genre(self, genre_id):
         return self.genres.get(genre_id, None)
     
@@ -352,9 +965,29 @@ class State:
         self.ensure_album(entry)
         self.ensure_track(entry)
     
-    def fill_genre_cumfreqs(self):
+    def fill_genre_cumfreqs(self, popularity='uniform', zipf_exponent=1.0):
+        assert popularity in self.POPULARITY_MODELS
+        # popularity belongs to the catalog, so it is drawn from a fixed seed rather than the run seed
+        streams = RngStreams(self.POPULARITY_SEED)
         for genre in self.genres.values():
             self.genre_cumfreqs.add_row(genre.id, genre.track_count)
+            if popularity != 'uniform':
+                weights = self.track_weights(genre, popularity, zipf_exponent, streams.stream('popularity', genre.id))
+                genre.sampler = AliasTable.new(genre.track_ids, weights)
+    
+    def track_weights(self, genre, popularity, zipf_exponent, rng):
+        if popularity == 'zipf':
+            # hits are spread over the genre instead of following catalog order
+            ranks = list(range(1, genre.track_count + 1))
+            rng.shuffle(ranks)
+            return [ 1.0 / rank ** zipf_exponent for rank in ranks ]
+        # artists with larger catalogs sell more of each track
+        weights = []
+        for track_id in genre.track_ids:
+            album = self.get_album(self.get_track(track_id).album_id)
+            artist = self.get_artist(album.artist_id)
+            weights.append(sum(len(self.get_album(album_id).track_ids) for album_id in artist.album_ids))
+        return weights
             
     def show(self):
         for artist in self.artists.values():
@@ -367,47 +1000,65 @@ class State:
                     genre = self.get_genre(track.genre_id)
                     print('\t\t', track.id, '-', genre.name, '-', track.name)
     
-    def pick_genre_preference(self, n):
+    def pick_genre_preference(self, n, rng):
         prefs = []
         for i in range(n):
-            genre_id = self.genre_cumfreqs.pick()
+            genre_id = self.genre_cumfreqs.pick(rng)
             if genre_id not in prefs:
                 prefs.append(genre_id)
         return prefs
     
-    def create_customer(self, db):
-        c = Customer.random(self)
+    def create_customer(self, db, rng):
+        c = Customer.random(self, rng)
         db.insert_customer(c)
         self.add_customer(c)
         return c
     
-    def sample_customer(self):
-        customer_id = random.choice(self.customer_ids)
+    def sample_customer(self, rng):
+        customer_id = rng.choice(self.customer_ids)
         return self.customers[customer_id]
 
-    def sample_track_for(self, customer):
-        genre_id    = random.choice(customer.preferences)
-        genre       = self.get_genre(genre_id)
-        track_id    = random.choice(genre.track_ids)
-        if track_id in customer.tracks_bought:
-            return None
-        return self.get_track(track_id)
+    def sample_tracks_for(self, customer, count, rng):
+        # draws the genres first, then all the tracks of each genre at once
+        genre_counts = {}
+        for i in range(count):
+            genre_id = rng.choice(customer.preferences)
+            genre_counts[genre_id] = genre_counts.get(genre_id, 0) + 1
+        tracks    = []
+        track_ids = set()
+        for genre_id, genre_count in genre_counts.items():
+            genre = self.get_genre(genre_id)
+            # owned tracks are redrawn, otherwise skewed popularity models shrink the baskets over time
+            for track_id in self.candidate_tracks(genre, genre_count, rng):
+                if track_id in customer.tracks_bought or track_id in track_ids:
+                    continue
+                tracks.append(self.get_track(track_id))
+                track_ids.add(track_id)
+                genre_count -= 1
+                if genre_count == 0:
+                    break
+        return tracks
+    
+    def candidate_tracks(self, genre, count, rng):
+        # the redraws are only drawn when the first batch had rejections, and all at once, since
+        # customers who own most of their genres reject nearly every draw
+        yield from genre.pick_tracks(rng, count)
+        yield from genre.pick_tracks(rng, count * self.TRACK_REDRAWS)
                 
-    def create_invoice(self, db, date):
-        customer = self.sample_customer()
+    def create_invoice(self, db, date, rng):
+        customer = self.sample_customer(rng)
         if customer.churned:
             return 0
-        customer.churned = (1 - self.CHURN_PROB) < random.random()
-        tracks   = []
+        return self.create_invoice_for(db, date, customer, rng)
+    
+    def create_invoice_for(self, db, date, customer, rng):
+        customer.churned = (1 - self.CHURN_PROB) < rng.random()
+        if customer.churned:
+            db.insert_customer_churn(customer.id, date)
         
-        r = random.lognormvariate(self.NUM_INVOICE_LINES_MU, self.NUM_INVOICE_LINES_SIGMA)
+        r = rng.lognormvariate(self.NUM_INVOICE_LINES_MU, self.NUM_INVOICE_LINES_SIGMA)
         num_lines = 1 + int(r)
-        
-        for i in range(num_lines):
-            track = self.sample_track_for(customer)
-            if track is None:
-                continue
-            tracks.append(track)
+        tracks = self.sample_tracks_for(customer, num_lines, rng)
         
         if not tracks:
             return 0
@@ -426,6 +1077,7 @@ class Genre:
     id: int
     name: str
     track_ids: List[int]
+    sampler: AliasTable
     state: State
     
     @classmethod
@@ -434,6 +1086,7 @@ class Genre:
             id          = entry.genre_id
         ,   name        = entry.genre
         ,   track_ids   = []
+        ,   sampler     = None
         ,   state       = state
         )
     
@@ -441,6 +1094,11 @@ class Genre:
     def track_count(self):
         return len(self.track_ids)
     
+    def pick_tracks(self, rng, count):
+        if self.sampler is None:
+            return rng.choices(self.track_ids, k=count)
+        return self.sampler.pick_many(rng, count)
+    
 @dataclass
 class Artist:
     id: int
@@ -502,11 +1160,7 @@ class Customer:
     first_name     : str
     last_name      : str
     company        : str
-    address        : str
-    city           : str
-    state          : str
-    country        : str
-    postal_code    : str
+    location_id    : int
     phone          : str
     fax            : str
     email          : str
@@ -672,35 +1326,54 @@ class Customer:
     LOCATIONS_CUMFREQ = CumFreqTable.new()
     
     @classmethod
-    def pick_location(klass):
+    def location(klass, location_id):
+        return klass.LOCATIONS[location_id - 1][0]
+    
+    @classmethod
+    def pick_location(klass, rng):
         if klass.LOCATIONS_CUMFREQ.maxcumfreq == 0:            
-            for value, freq in klass.LOCATIONS:
-                klass.LOCATIONS_CUMFREQ.add_row(value, freq)
-        country, state, city = klass.LOCATIONS_CUMFREQ.pick()
-        return country, state, city
+            for i, (value, freq) in enumerate(klass.LOCATIONS):
+                klass.LOCATIONS_CUMFREQ.add_row(i + 1, freq)
+        return klass.LOCATIONS_CUMFREQ.pick(rng)
+    
+    @property
+    def address(self):
+        return self.DEFAULT_ADDRESS
+    
+    @property
+    def city(self):
+        return self.location(self.location_id)[self.LOCATION_CITY_IDX]
+    
+    @property
+    def state(self):
+        return self.location(self.location_id)[self.LOCATION_STATE_IDX]
+    
+    @property
+    def country(self):
+        return self.location(self.location_id)[self.LOCATION_COUNTRY_IDX]
+    
+    @property
+    def postal_code(self):
+        return self.DEFAULT_POSTAL_CODE
         
     @classmethod
-    def random(klass, db_state):
-        first_name = random.choice(klass.FIRST_NAMES)
-        last_name = random.choice(klass.LAST_NAMES) + ' ' + random.choice(klass.LAST_NAMES)
-        country, state, city = klass.pick_location()
+    def random(klass, db_state, rng):
+        first_name = rng.choice(klass.FIRST_NAMES)
+        last_name = rng.choice(klass.LAST_NAMES) + ' ' + rng.choice(klass.LAST_NAMES)
+        location_id = klass.pick_location(rng)
         return klass(
             id             = None
         ,   first_name     = first_name
         ,   last_name      = last_name
         ,   company        = klass.DEFAULT_COMPANY
-        ,   address        = klass.DEFAULT_ADDRESS
-        ,   city           = city
-        ,   state          = state
-        ,   country        = country
-        ,   postal_code    = klass.DEFAULT_POSTAL_CODE
+        ,   location_id    = location_id
         ,   phone          = klass.DEFAULT_PHONE
         ,   fax            = None
         ,   email          = klass.DEFAULT_EMAIL
         ,   support_rep_id = klass.DEFAULT_SUPPORT_REP_ID
         ,   churned        = False
         ,   db_state       = db_state
-        ,   preferences    = db_state.pick_genre_preference(klass.PREFERENCE_COUNT)
+        ,   preferences    = db_state.pick_genre_preference(klass.PREFERENCE_COUNT, rng)
         ,   tracks_bought  = set()
         )
 
@@ -727,11 +1400,7 @@ class Invoice:
     id           : int
     customer_id  : int
     invoice_date : str
-    address      : str
-    city         : str
-    state        : str
-    country      : str
-    postal_code  : str
+    location_id  : int
     total        : float
 
     @classmethod
@@ -740,14 +1409,90 @@ class Invoice:
             id           = None
         ,   customer_id  = customer.id
         ,   invoice_date = date
-        ,   address      = Customer.DEFAULT_ADDRESS
-        ,   city         = customer.city
-        ,   state        = customer.state
-        ,   country      = customer.country
-        ,   postal_code  = Customer.DEFAULT_POSTAL_CODE
+        ,   location_id  = customer.location_id
         ,   total        = 0.0
         )
     
+    @property
+    def address(self):
+        return Customer.DEFAULT_ADDRESS
+    
+    @property
+    def city(self):
+        return Customer.location(self.location_id)[Customer.LOCATION_CITY_IDX]
+    
+    @property
+    def state(self):
+        return Customer.location(self.location_id)[Customer.LOCATION_STATE_IDX]
+    
+    @property
+    def country(self):
+        return Customer.location(self.location_id)[Customer.LOCATION_COUNTRY_IDX]
+    
+    @property
+    def postal_code(self):
+        return Customer.DEFAULT_POSTAL_CODE
+    
+class ReferenceEngine(object):
+    
+    NAME = 'reference'
+    
+    def __init__(self, state):
+        self.state = state
+    
+    def create_invoices_for_day(self, db, date, num_invoices, streams):
+        # one stream per invoice slot, so a slot's draws never depend on what earlier slots consumed
+        day = date.toordinal()
+        created_invoices = 0
+        for i in range(num_invoices):
+            rng = streams.stream('invoice', day, i)
+            created_invoices += self.state.create_invoice(db, date, rng)
+        return created_invoices
+
+class ScheduledEngine(object):
+    
+    # keeps a heap of (next purchase time, customer id) for the active customers, with times as
+    # fractional day ordinals. Each day pops the planned number of earliest purchases, so the cost
+    # is proportional to the invoices generated instead of to the customer draws attempted.
+    # Each purchase draws from a stream keyed by its customer and due time
+    
+    NAME = 'scheduled'
+    
+    def __init__(self, state):
+        self.state = state
+        self.queue = None
+    
+    def schedule(self, when, customer_id, mean_interval, rng):
+        heapq.heappush(self.queue, (when + rng.expovariate(1.0 / mean_interval), customer_id))
+    
+    def fill_queue(self, date, num_invoices, streams):
+        mean_interval = len(self.state.customer_ids) / max(num_invoices, 1)
+        day = date.toordinal()
+        self.queue = [
+            (day + streams.stream('schedule', customer_id).expovariate(1.0 / mean_interval), customer_id)
+            for customer_id in self.state.customer_ids
+        ]
+        heapq.heapify(self.queue)
+    
+    def create_invoices_for_day(self, db, date, num_invoices, streams):
+        if self.queue is None:
+            self.fill_queue(date, num_invoices, streams)
+        day = date.toordinal()
+        # purchases due later are pulled forward and surplus ones roll over, which keeps daily totals on plan.
+        # Customers are pushed back after buying, so a customer may buy more than once a day
+        mean_interval = len(self.queue) / max(num_invoices, 1)
+        created_invoices = 0
+        for i in range(num_invoices):
+            if not self.queue:
+                break # every customer churned
+            when, customer_id = heapq.heappop(self.queue)
+            customer = self.state.get_customer(customer_id)
+            rng = streams.stream('purchase', customer_id, when)
+            created_invoices += self.state.create_invoice_for(db, date, customer, rng)
+            if not customer.churned:
+                self.schedule(max(when, day), customer_id, mean_interval, rng)
+        return created_invoices
+
 class App(object):
     
     GLOBAL_MEAN         = 500.0
@@ -773,94 +1518,985 @@ class App(object):
     ,   12 : { 'mu': GLOBAL_MEAN, 'sigma': GLOBAL_SIGMA, 'seasonality': 0.099441819 }
     }
     
+    ENGINES = {
+        ReferenceEngine.NAME : ReferenceEngine
+    ,   ScheduledEngine.NAME : ScheduledEngine
+    }
 
-    def __init__(self, in_db, out_db, num_customers, start_date, end_date):
+    def __init__(self, in_db, out_db, num_customers, start_date, end_date, engine=ReferenceEngine.NAME, seed=None, popularity='uniform', zipf_exponent=1.0, trickle=None, compact=False, lazy_customers=False):
         assert in_db.endswith('.db')
         assert out_db.endswith('.db')
         assert in_db != out_db
         assert os.path.exists(in_db)
+        assert engine in self.ENGINES
+        assert popularity in State.POPULARITY_MODELS
         self.in_db          = in_db
         self.out_db         = out_db
         self.num_customers  = num_customers
         self.start_date     = start_date
         self.end_date       = end_date
+        self.engine         = engine
+        self.popularity     = popularity
+        self.zipf_exponent  = zipf_exponent
+        self.trickle        = trickle
+        self.compact        = compact
+        self.lazy_customers = lazy_customers
+        self.seed           = RngStreams.random_seed() if seed is None else seed
+        self.streams        = RngStreams(self.seed)
         self.factor         = 1.0
-    
-    def info(self, msg):
-        when = str(dt.datetime.now())
-        print(f"INFO - {when} - {msg}", file=sys.stderr)
+        self.invoice_count  = 0
+        self.timings        = {}
     
     def copy_db(self):
-        self.info(f'copying db from {self.in_db} to {self.out_db}')
+        info(f'copying db from {self.in_db} to {self.out_db}')
         shutil.copyfile(self.in_db, self.out_db)
         
     def connect_db(self):
-        self.info(f"connecting to db at {self.out_db}")
-        db = Db(self.out_db)
+        info(f"connecting to db at {self.out_db}")
+        if self.trickle is not None:
+            return TrickleDb(self.out_db, self.trickle, self.compact)
+        db = Db(self.out_db, self.compact)
         return db
     
-    def fetch_state(self, db):
-        self.info('fetching application state')
-        state = State.new()
-        db.open()
-        entries = db.fetch_music_data()
-        db.close()
-        for entry in entries:
-            state.process_entry(entry)
-        state.fill_genre_cumfreqs()
+    def fetch_state(self, db, catalog=None):
+        info('fetching application state')
+        if catalog is None:
+            catalog = Catalog.from_db(db)
+        state = catalog.new_state(self.popularity, self.zipf_exponent)
         #state.show()
         return state
     
+    def create_compact_schema(self, db):
+        info('creating compact location schema')
+        db.open()
+        db.create_compact_schema()
+        db.commit()
+        db.close()
+    
     def create_customers(self, db, state):
-        self.info(f'creating {self.num_customers} customers')
+        info(f'creating {self.num_customers} customers')
         db.open()
-        for i in range(self.num_customers):
-            c = state.create_customer(db)
+        if self.lazy_customers:
+            customers = LazyCustomers(state, self.streams, db.next_customer_id(), self.num_customers)
+            db.insert_customers_bulk(customers.derive_all())
+            state.customers = customers
+            state.customer_ids = customers.ids
+        else:
+            for i in range(self.num_customers):
+                c = state.create_customer(db, self.streams.stream('customer', i))
         db.commit()
         db.close()
 
-    def compute_num_invoices(self, date, switch_factor):
+    def compute_num_invoices(self, date, switch_factor, rng):
         parameters       = self.MONTH_PARAMETERS[ date.month ]
         effective_factor = self.factor + parameters['seasonality']
-        noise            = random.normalvariate(self.NOISE_MEAN, self.NOISE_SIGMA)
-        r                = random.normalvariate(parameters['mu'], parameters['sigma'])
+        noise            = rng.normalvariate(self.NOISE_MEAN, self.NOISE_SIGMA)
+        r                = rng.normalvariate(parameters['mu'], parameters['sigma'])
         result           = int((r + noise) * effective_factor)
         if switch_factor:
             self.factor -= self.DAILY_GROWTH_FACTOR
         else:
             self.factor += self.DAILY_GROWTH_FACTOR
         return result
+    
+    def plan_invoices(self):
+        # the growth factor is a random walk, so the whole plan is drawn upfront from its own stream
+        rng = self.streams.stream('plan')
+        plan = []
+        date = self.start_date
+        switch_factor = False
+        while date < self.end_date:
+            if (1 - self.SWITCH_FACTOR_PROB) < rng.random():
+                switch_factor = not switch_factor
+            num_invoices = self.compute_num_invoices(date, switch_factor, rng)
+            plan.append((date, num_invoices))
+            date = date + dt.timedelta(1)
+        return plan
         
     def create_invoices(self, db, state):
-        self.info(f'creating invoices')
+        info(f'creating invoices with the {self.engine} engine')
+        engine = self.ENGINES[self.engine](state)
         db.open()
         db.clear_old_invoices()
         db.commit() # intermediate commit
-        date = self.start_date
-        switch_factor = False
-        while date < self.end_date:
-            created_invoices = 0
-            if (1 - self.SWITCH_FACTOR_PROB) < random.random():
-                switch_factor = not switch_factor
-            num_invoices = self.compute_num_invoices(date, switch_factor)
-            #self.info(f'creating {num_invoices} invoices for date {date}')
-            for i in range(num_invoices):
-                created_invoices += state.create_invoice(db, date)
-            self.info(f'created {created_invoices} from {num_invoices} invoices computed for date {date}')
+        probe = None
+        if self.trickle is not None and self.trickle.probe_interval:
+            probe = ReaderProbe(self.out_db, self.trickle.probe_interval)
+            probe.start()
+        for date, num_invoices in self.plan_invoices():
+            #info(f'creating {num_invoices} invoices for date {date}')
+            if self.trickle is not None:
+                db.start_day(date, num_invoices)
+            created_invoices = engine.create_invoices_for_day(db, date, num_invoices, self.streams)
+            self.invoice_count += created_invoices
+            info(f'created {created_invoices} from {num_invoices} invoices computed for date {date}')
+            db.insert_daily_plan(date, num_invoices, created_invoices)
             db.commit() # intermediate commit
-            date = date + dt.timedelta(1)
         db.close()
+        if self.trickle is not None:
+            info(f'trickle writer metrics: {json.dumps(db.metrics())}')
+        if probe is not None:
+            probe.stop()
+            info(f'trickle reader metrics: {json.dumps(probe.metrics())}')
         
-    def run(self):
-        self.info('starting invoice generator')
-        self.copy_db()
+    def timed(self, phase, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings[phase] = time.perf_counter() - start
+        return result
+    
+    def run(self, catalog=None):
+        info(f'starting invoice generator with seed {self.seed}')
+        self.timed('copy', self.copy_db)
         db = self.connect_db()
-        state = self.fetch_state(db)
-        self.create_customers(db, state)
-        self.create_invoices(db, state)
-        self.info('finished')
+        state = self.timed('state', self.fetch_state, db, catalog)
+        if self.compact:
+            self.timed('schema', self.create_compact_schema, db)
+        self.timed('customers', self.create_customers, db, state)
+        self.timed('invoices', self.create_invoices, db, state)
+        info('finished')
         
-if __name__ == '__main__':
+@dataclass
+class CheckResult:
+    name        : str
+    count       : int
+    first_ids   : List[object]
+    missing     : List[str]
+
+    @classmethod
+    def new(klass, name):
+        return klass(name=name, count=0, first_ids=[], missing=[])
+    
+    @property
+    def ok(self):
+        return self.count == 0
+    
+    @property
+    def skipped(self):
+        return len(self.missing) > 0
+    
+    def merge(self, other, max_ids):
+        assert self.name == other.name
+        self.count += other.count
+        self.first_ids = sorted(self.first_ids + other.first_ids)[:max_ids]
+
+class Verifier(object):
+    
+    PARTITION_INVOICE   = 'invoice'
+    PARTITION_CUSTOMER  = 'customer'
+    
+    # partitioned checks take a [start, end) key range, the others run once over the whole DB.
+    # Every check returns the offending ids ordered. Generated invoice ids follow invoice dates, so
+    # invoice id ranges are date ranges seeked through the primary key
+    CHECKS = {
+        'invoice_totals' : (PARTITION_INVOICE, """
+            SELECT  a.InvoiceId
+            FROM    invoices a
+                    --
+                    LEFT JOIN invoice_items b
+                    ON  a.InvoiceId = b.InvoiceId
+                    --
+            WHERE   a.InvoiceId >= ?
+            AND     a.InvoiceId <  ?
+            GROUP   BY a.InvoiceId
+            HAVING  COUNT(b.InvoiceLineId) = 0
+            OR      ABS(a.Total - SUM(b.UnitPrice * b.Quantity)) > 0.005
+            ORDER   BY 1
+        """)
+    ,   'duplicate_purchases' : (PARTITION_CUSTOMER, """
+            SELECT  MAX(b.InvoiceLineId)
+            FROM    invoices a
+                    --
+                    INNER JOIN invoice_items b
+                    ON  a.InvoiceId = b.InvoiceId
+                    --
+            WHERE   a.CustomerId >= ?
+            AND     a.CustomerId <  ?
+            GROUP   BY a.CustomerId, b.TrackId
+            HAVING  COUNT(*) > 1
+            ORDER   BY 1
+        """)
+    ,   'churned_purchases' : (PARTITION_INVOICE, """
+            SELECT  a.InvoiceId
+            FROM    invoices a
+                    --
+                    INNER JOIN gen_customer_churn b
+                    ON  a.CustomerId = b.CustomerId
+                    --
+            WHERE   a.InvoiceId >= ?
+            AND     a.InvoiceId <  ?
+            AND     a.InvoiceDate >  b.ChurnDate
+            ORDER   BY 1
+        """)
+    ,   'daily_counts' : (None, """
+            WITH    counts AS (
+                        SELECT  InvoiceDate
+                        ,       COUNT(*) AS invoices
+                        FROM    invoices
+                        GROUP   BY InvoiceDate
+                    )
+            SELECT  a.PlanDate
+            FROM    gen_daily_plan a
+                    --
+                    LEFT JOIN counts b
+                    ON  a.PlanDate = b.InvoiceDate
+                    --
+            WHERE   a.CreatedInvoices > a.PlannedInvoices
+            OR      a.CreatedInvoices <> COALESCE(b.invoices, 0)
+            ORDER   BY 1
+        """)
+    ,   'unplanned_days' : (PARTITION_INVOICE, """
+            SELECT  a.InvoiceId
+            FROM    invoices a
+            WHERE   a.InvoiceId >= ?
+            AND     a.InvoiceId <  ?
+            AND     NOT EXISTS (
+                        SELECT  1
+                        FROM    gen_daily_plan b
+                        WHERE   b.PlanDate = a.InvoiceDate
+                    )
+            ORDER   BY 1
+        """)
+    }
+    
+    # generator bookkeeping tables, absent from the source DB and from DBs generated before them
+    CHECK_TABLES = {
+        'churned_purchases' : ('gen_customer_churn',)
+    ,   'daily_counts'      : ('gen_daily_plan',)
+    ,   'unplanned_days'    : ('gen_daily_plan',)
+    }
+    
+    SQL_KEY_RANGES = {
+        PARTITION_INVOICE   : "SELECT MIN(InvoiceId), MAX(InvoiceId) FROM invoices"
+    ,   PARTITION_CUSTOMER  : "SELECT MIN(CustomerId), MAX(CustomerId) FROM invoices"
+    }
+    SQL_CREATE_INVOICE_DATE_INDEX = """
+        CREATE INDEX IF NOT EXISTS IX_InvoiceDate ON invoices(InvoiceDate);
+    """
+    SQL_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table'"
+    MAX_IDS = 10
+    
+    def __init__(self, dbfile, partitions, workers, create_index=False):
+        assert dbfile.endswith('.db')
+        assert os.path.exists(dbfile)
+        assert partitions > 0
+        assert workers > 0
+        self.dbfile         = dbfile
+        self.partitions     = partitions
+        self.workers        = workers
+        self.create_index   = create_index
+    
+    def connect_ro(self):
+        uri = 'file:' + os.path.abspath(self.dbfile) + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    
+    def ensure_index(self):
+        # lets daily_counts group invoices by date from a covering index instead of sorting them
+        info('ensuring index on invoices(InvoiceDate)')
+        conn = sqlite3.connect(self.dbfile)
+        conn.execute(self.SQL_CREATE_INVOICE_DATE_INDEX)
+        conn.commit()
+        conn.close()
+    
+    def fetch_tables(self):
+        conn = self.connect_ro()
+        tables = { row[0] for row in conn.execute(self.SQL_TABLES) }
+        conn.close()
+        return tables
+    
+    def fetch_key_ranges(self):
+        key_ranges = {}
+        conn = self.connect_ro()
+        for partition, sql in self.SQL_KEY_RANGES.items():
+            lo, hi = conn.execute(sql).fetchone()
+            key_ranges[partition] = None if lo is None else self.split_range(lo, hi + 1)
+        conn.close()
+        return key_ranges
+    
+    def split_range(self, start, end):
+        size = max(1, math.ceil((end - start) / self.partitions))
+        return [ (lo, min(end, lo + size)) for lo in range(start, end, size) ]
+    
+    def run_check(self, name, params):
+        result = CheckResult.new(name)
+        _, sql = self.CHECKS[name]
+        conn = self.connect_ro()
+        try:
+            cursor = conn.execute(sql, params)
+            for row in cursor:
+                if result.count < self.MAX_IDS:
+                    result.first_ids.append(row[0])
+                result.count += 1
+        finally:
+            conn.close()
+        return result
+    
+    def tasks(self, key_ranges, results):
+        for name, (partition, _) in self.CHECKS.items():
+            if results[name].skipped:
+                continue
+            if partition is None:
+                yield name, ()
+            elif key_ranges[partition] is not None:
+                for lo, hi in key_ranges[partition]:
+                    yield name, (lo, hi)
+    
+    def verify(self):
+        if self.create_index:
+            self.ensure_index()
+        tables = self.fetch_tables()
+        key_ranges = self.fetch_key_ranges()
+        results = { name: CheckResult.new(name) for name in self.CHECKS }
+        for name, required in self.CHECK_TABLES.items():
+            results[name].missing = [ table for table in required if table not in tables ]
+        tasks = list(self.tasks(key_ranges, results))
+        info(f'verifying in {len(tasks)} tasks with {self.workers} workers')
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [ executor.submit(self.run_check, name, params) for name, params in tasks ]
+            for future in futures:
+                partial = future.result()
+                results[partial.name].merge(partial, self.MAX_IDS)
+        return list(results.values())
+    
+    def report(self, results):
+        for result in results:
+            if result.skipped:
+                print(f'SKIP - {result.name:<20} - missing table ' + ', '.join(result.missing))
+                continue
+            status = 'OK' if result.ok else 'FAIL'
+            line = f'{status:<4} - {result.name:<20} - {result.count} offending rows'
+            if not result.ok:
+                line += ' - first ids: ' + ', '.join(str(id) for id in result.first_ids)
+            print(line)
+        return all(result.ok for result in results)
+    
+    def run(self):
+        info(f'verifying {self.dbfile}')
+        results = self.verify()
+        ok = self.report(results)
+        info('finished')
+        return ok
+
+@dataclass
+class Profile:
+    daily_counts        : List[int]
+    monthly_counts      : Dict[str, int]
+    lines_mix           : Dict[int, float]
+    genre_mix           : Dict[str, float]
+    location_mix        : Dict[str, float]
+    churn_curve         : Dict[str, float]
+    total_revenue       : float
+    invoice_count       : int
+    planned_invoices    : int
+    line_count          : int
+    active_customers    : int
+    
+    MAX_LINES_BUCKET = 10
+    
+    SQL_DAILY_COUNTS = """
+        SELECT  a.PlanDate
+        ,       COUNT(b.InvoiceId)
+        FROM    gen_daily_plan a
+                --
+                LEFT JOIN invoices b
+                ON  a.PlanDate = b.InvoiceDate
+                --
+        GROUP   BY a.PlanDate
+        ORDER   BY 1
+    """
+    SQL_LINES_PER_INVOICE = """
+        SELECT  num_lines
+        ,       COUNT(*)
+        FROM    (
+                    SELECT  COUNT(*) AS num_lines
+                    FROM    invoice_items
+                    GROUP   BY InvoiceId
+                )
+        GROUP   BY num_lines
+    """
+    SQL_GENRE_MIX = """
+        SELECT  c.Name
+        ,       COUNT(*)
+        FROM    invoice_items a
+                --
+                INNER JOIN tracks b
+                ON  a.TrackId = b.TrackId
+                --
+                INNER JOIN genres c
+                ON  b.GenreId = c.GenreId
+                --
+        GROUP   BY c.Name
+    """
+    SQL_LOCATION_MIX = """
+        SELECT  BillingCountry || '/' || BillingState
+        ,       COUNT(*)
+        FROM    {invoices}
+        GROUP   BY 1
+    """
+    SQL_CHURN_BY_MONTH = """
+        SELECT  SUBSTR(ChurnDate, 1, 7)
+        ,       COUNT(*)
+        FROM    gen_customer_churn
+        GROUP   BY 1
+        ORDER   BY 1
+    """
+    SQL_ACTIVE_CUSTOMERS = """
+        SELECT  COUNT(DISTINCT CustomerId)
+        FROM    invoices
+    """
+    SQL_PLANNED_INVOICES = """
+        SELECT  COALESCE(SUM(PlannedInvoices), 0)
+        FROM    gen_daily_plan
+    """
+    SQL_REVENUE = """
+        SELECT  COALESCE(SUM(Total), 0.0)
+        ,       COUNT(*)
+        FROM    invoices
+    """
+    
+    @classmethod
+    def shares(klass, rows):
+        total = sum(count for _, count in rows)
+        if total == 0:
+            return {}
+        return { key: count / total for key, count in rows }
+    
+    @classmethod
+    def from_db(klass, dbfile):
+        conn = sqlite3.connect(dbfile)
+        daily = conn.execute(klass.SQL_DAILY_COUNTS).fetchall()
+        monthly_counts = {}
+        for date, count in daily:
+            month = date[:7]
+            monthly_counts[month] = monthly_counts.get(month, 0) + count
+        lines = {}
+        line_count = 0
+        for num_lines, count in conn.execute(klass.SQL_LINES_PER_INVOICE):
+            bucket = min(num_lines, klass.MAX_LINES_BUCKET)
+            lines[bucket] = lines.get(bucket, 0) + count
+            line_count += num_lines * count
+        active_customers, = conn.execute(klass.SQL_ACTIVE_CUSTOMERS).fetchone()
+        churn_curve = {}
+        churned = 0
+        for month, count in conn.execute(klass.SQL_CHURN_BY_MONTH):
+            churned += count
+            churn_curve[month] = churned / max(active_customers, 1)
+        total_revenue, invoice_count = conn.execute(klass.SQL_REVENUE).fetchone()
+        planned_invoices, = conn.execute(klass.SQL_PLANNED_INVOICES).fetchone()
+        profile = klass(
+            daily_counts     = [ count for _, count in daily ]
+        ,   monthly_counts   = monthly_counts
+        ,   lines_mix        = klass.shares(lines.items())
+        ,   genre_mix        = klass.shares(conn.execute(klass.SQL_GENRE_MIX).fetchall())
+        ,   location_mix     = klass.shares(conn.execute(klass.SQL_LOCATION_MIX.format(invoices=Db.invoices_relation(conn))).fetchall())
+        ,   churn_curve      = churn_curve
+        ,   total_revenue    = total_revenue
+        ,   invoice_count    = invoice_count
+        ,   planned_invoices = planned_invoices
+        ,   line_count       = line_count
+        ,   active_customers = active_customers
+        )
+        conn.close()
+        return profile
+    
+    @property
+    def churned_share(self):
+        return max(self.churn_curve.values(), default=0.0)
+    
+    @property
+    def plan_attainment(self):
+        return self.invoice_count / max(self.planned_invoices, 1)
+    
+    @property
+    def mean_daily_invoices(self):
+        return statistics.fmean(self.daily_counts) if self.daily_counts else 0.0
+    
+    @property
+    def mean_lines_per_invoice(self):
+        return self.line_count / max(self.invoice_count, 1)
+    
+    @property
+    def revenue_per_invoice(self):
+        return self.total_revenue / max(self.invoice_count, 1)
+
+@dataclass
+class MetricCheck:
+    name        : str
+    reference   : float
+    candidate   : float
+    diff        : float
+    tolerance   : float
+    
+    @property
+    def ok(self):
+        return self.diff <= self.tolerance
+
+class Harness(object):
+    
+    # relative differences for scalars, total variation distance for mixes, absolute difference for the churn curve.
+    # The churn curve tolerance is a floor, widened to the sampling noise of the churned share on small populations
+    TOLERANCES = {
+        'plan_attainment'           : 0.05
+    ,   'invoices_per_day.mean'     : 0.05
+    ,   'invoices_per_month.max'    : 0.10
+    ,   'lines_per_invoice.mean'    : 0.05
+    ,   'lines_per_invoice.mix'     : 0.05
+    ,   'genre.mix'                 : 0.10
+    ,   'location.mix'              : 0.10
+    ,   'churn_curve.max'           : 0.02
+    ,   'revenue.total'             : 0.10
+    ,   'revenue.per_invoice'       : 0.05
+    }
+    CHURN_SIGMAS = 3.0
+    
+    def __init__(self, in_db, out_dir, num_customers, start_date, end_date, reference, candidate, seed=None):
+        assert os.path.isdir(out_dir)
+        assert reference in App.ENGINES
+        assert candidate in App.ENGINES
+        self.in_db          = in_db
+        self.out_dir        = out_dir
+        self.num_customers  = num_customers
+        self.start_date     = start_date
+        self.end_date       = end_date
+        self.reference      = reference
+        self.candidate      = candidate
+        self.seed           = RngStreams.random_seed() if seed is None else seed
+    
+    @staticmethod
+    def rel_diff(a, b):
+        return abs(a - b) / max(abs(a), 1e-9)
+    
+    @staticmethod
+    def tvd(p, q):
+        keys = set(p) | set(q)
+        return 0.5 * sum(abs(p.get(k, 0.0) - q.get(k, 0.0)) for k in keys)
+    
+    @classmethod
+    def max_rel_diff(klass, p, q):
+        keys = set(p) | set(q)
+        return max((klass.rel_diff(p.get(k, 0), q.get(k, 0)) for k in keys), default=0.0)
+    
+    @classmethod
+    def churn_tolerance(klass, ref, cand):
+        # standard error of the difference between two independent binomial shares
+        n = max(min(ref.active_customers, cand.active_customers), 1)
+        p = (ref.churned_share + cand.churned_share) / 2
+        noise = klass.CHURN_SIGMAS * math.sqrt(2 * p * (1 - p) / n)
+        return max(klass.TOLERANCES['churn_curve.max'], noise)
+    
+    @staticmethod
+    def max_abs_diff(p, q):
+        # cumulative curves carry their last value forward over missing months
+        keys = sorted(set(p) | set(q))
+        last_p = last_q = result = 0.0
+        for k in keys:
+            last_p = p.get(k, last_p)
+            last_q = q.get(k, last_q)
+            result = max(result, abs(last_p - last_q))
+        return result
+    
+    def generate(self, role, engine):
+        out_db = os.path.join(self.out_dir, f'{role}-{engine}.db')
+        app = App(self.in_db, out_db, self.num_customers, self.start_date, self.end_date, engine=engine, seed=self.seed)
+        app.run()
+        # only the invoice phase, copying the DB and loading the catalog cost the same for every engine
+        return out_db, app.timings['invoices']
+    
+    def compare(self, ref, cand):
+        measures = [
+            ('plan_attainment',         ref.plan_attainment,        cand.plan_attainment,           self.rel_diff(ref.plan_attainment, cand.plan_attainment))
+        ,   ('invoices_per_day.mean',   ref.mean_daily_invoices,    cand.mean_daily_invoices,       self.rel_diff(ref.mean_daily_invoices, cand.mean_daily_invoices))
+        ,   ('invoices_per_month.max',  None,                       None,                           self.max_rel_diff(ref.monthly_counts, cand.monthly_counts))
+        ,   ('lines_per_invoice.mean',  ref.mean_lines_per_invoice, cand.mean_lines_per_invoice,    self.rel_diff(ref.mean_lines_per_invoice, cand.mean_lines_per_invoice))
+        ,   ('lines_per_invoice.mix',   None,                       None,                           self.tvd(ref.lines_mix, cand.lines_mix))
+        ,   ('genre.mix',               None,                       None,                           self.tvd(ref.genre_mix, cand.genre_mix))
+        ,   ('location.mix',            None,                       None,                           self.tvd(ref.location_mix, cand.location_mix))
+        ,   ('churn_curve.max',         None,                       None,                           self.max_abs_diff(ref.churn_curve, cand.churn_curve))
+        ,   ('revenue.total',           ref.total_revenue,          cand.total_revenue,             self.rel_diff(ref.total_revenue, cand.total_revenue))
+        ,   ('revenue.per_invoice',     ref.revenue_per_invoice,    cand.revenue_per_invoice,       self.rel_diff(ref.revenue_per_invoice, cand.revenue_per_invoice))
+        ]
+        tolerances = dict(self.TOLERANCES)
+        tolerances['churn_curve.max'] = self.churn_tolerance(ref, cand)
+        return [
+            MetricCheck(name, r, c, diff, tolerances[name])
+            for name, r, c, diff in measures
+        ]
+    
+    def report(self, checks, ref, cand, ref_elapsed, cand_elapsed):
+        fmt = lambda v: '-' if v is None else f'{v:.4f}'
+        for check in checks:
+            status = 'PASS' if check.ok else 'FAIL'
+            print(f'{status} - {check.name:<24} - ref {fmt(check.reference):>12} - cand {fmt(check.candidate):>12} - diff {check.diff:.4f} (tol {check.tolerance:.4f})')
+        for name, profile, elapsed in ((self.reference, ref, ref_elapsed), (self.candidate, cand, cand_elapsed)):
+            rate = profile.invoice_count / max(elapsed, 1e-9)
+            print(f'THROUGHPUT - {name:<12} - {profile.invoice_count} invoices in {elapsed:.2f}s - {rate:.1f} invoices/s')
+        print(f'SPEEDUP - {ref_elapsed / max(cand_elapsed, 1e-9):.2f}x')
+        return all(check.ok for check in checks)
+    
+    def run(self):
+        info(f'comparing engine {self.candidate} against {self.reference} with seed {self.seed}')
+        ref_db, ref_elapsed = self.generate('reference', self.reference)
+        cand_db, cand_elapsed = self.generate('candidate', self.candidate)
+        ref = Profile.from_db(ref_db)
+        cand = Profile.from_db(cand_db)
+        checks = self.compare(ref, cand)
+        ok = self.report(checks, ref, cand, ref_elapsed, cand_elapsed)
+        info('finished')
+        return ok
+
+@dataclass
+class QueryTiming:
+    name    : str
+    times   : List[float]
+    plan    : List[str]
+    
+    @property
+    def median(self):
+        return statistics.median(self.times)
+    
+    def uses(self, index_name):
+        # whole plan token, IX_Bench_InvoiceLocation is a prefix of IX_Bench_InvoiceLocationId
+        pattern = re.compile(rf'\bINDEX {re.escape(index_name)}\b')
+        return any(pattern.search(line) for line in self.plan)
+
+class Benchmark(object):
+    
+    QUERIES = {
+        'revenue_by_month' : """
+            SELECT  SUBSTR(InvoiceDate, 1, 7)   AS month
+            ,       COUNT(*)                    AS invoices
+            ,       SUM(Total)                  AS revenue
+            FROM    invoices
+            GROUP   BY 1
+            ORDER   BY 1
+        """
+    ,   'revenue_by_genre' : """
+            SELECT  c.Name                          AS genre
+            ,       SUM(a.UnitPrice * a.Quantity)   AS revenue
+            FROM    invoice_items a
+                    --
+                    INNER JOIN tracks b
+                    ON  a.TrackId = b.TrackId
+                    --
+                    INNER JOIN genres c
+                    ON  b.GenreId = c.GenreId
+                    --
+            GROUP   BY c.Name
+            ORDER   BY 2 DESC
+        """
+    ,   'revenue_by_country' : """
+            SELECT  BillingCountry  AS country
+            ,       BillingState    AS state
+            ,       COUNT(*)        AS invoices
+            ,       SUM(Total)      AS revenue
+            FROM    {invoices}
+            GROUP   BY 1, 2
+            ORDER   BY 4 DESC
+        """
+    ,   'top_artists' : """
+            SELECT  d.Name                          AS artist
+            ,       SUM(a.UnitPrice * a.Quantity)   AS revenue
+            FROM    invoice_items a
+                    --
+                    INNER JOIN tracks b
+                    ON  a.TrackId = b.TrackId
+                    --
+                    INNER JOIN albums c
+                    ON  b.AlbumId = c.AlbumId
+                    --
+                    INNER JOIN artists d
+                    ON  c.ArtistId = d.ArtistId
+                    --
+            GROUP   BY d.ArtistId
+            ORDER   BY 2 DESC
+            LIMIT   10
+        """
+    ,   'customer_cohorts' : """
+            WITH    cohorts AS (
+                        SELECT  CustomerId
+                        ,       MIN(SUBSTR(InvoiceDate, 1, 7)) AS cohort
+                        FROM    invoices
+                        GROUP   BY CustomerId
+                    )
+            SELECT  b.cohort
+            ,       SUBSTR(a.InvoiceDate, 1, 7)     AS month
+            ,       COUNT(DISTINCT a.CustomerId)    AS customers
+            FROM    invoices a
+                    --
+                    INNER JOIN cohorts b
+                    ON  a.CustomerId = b.CustomerId
+                    --
+            GROUP   BY 1, 2
+            ORDER   BY 1, 2
+        """
+    ,   'customer_churn' : """
+            WITH    last_purchases AS (
+                        SELECT  CustomerId
+                        ,       MAX(InvoiceDate) AS last_purchase
+                        FROM    invoices
+                        GROUP   BY CustomerId
+                    )
+            SELECT  SUBSTR(last_purchase, 1, 7) AS month
+            ,       COUNT(*)                    AS churned_customers
+            FROM    last_purchases
+            WHERE   last_purchase < DATE((SELECT MAX(InvoiceDate) FROM invoices), '-90 days')
+            GROUP   BY 1
+            ORDER   BY 1
+        """
+    ,   'basket_size' : """
+            SELECT  num_lines
+            ,       COUNT(*)    AS invoices
+            ,       AVG(amount) AS avg_amount
+            FROM    (
+                        SELECT  InvoiceId
+                        ,       COUNT(*)                    AS num_lines
+                        ,       SUM(UnitPrice * Quantity)   AS amount
+                        FROM    invoice_items
+                        GROUP   BY InvoiceId
+                    )
+            GROUP   BY num_lines
+            ORDER   BY num_lines
+        """
+    }
+    
+    CANDIDATE_INDEXES = {
+        'IX_Bench_InvoiceDateTotal'     : 'CREATE INDEX IX_Bench_InvoiceDateTotal    ON invoices(InvoiceDate, Total)'
+    ,   'IX_Bench_InvoiceCustomerDate'  : 'CREATE INDEX IX_Bench_InvoiceCustomerDate ON invoices(CustomerId, InvoiceDate)'
+    ,   'IX_Bench_InvoiceLocation'      : 'CREATE INDEX IX_Bench_InvoiceLocation     ON invoices(BillingCountry, BillingState, Total)'
+    ,   'IX_Bench_InvoiceLocationId'    : 'CREATE INDEX IX_Bench_InvoiceLocationId   ON invoices(LocationId, Total)'
+    ,   'IX_Bench_ItemInvoiceAmount'    : 'CREATE INDEX IX_Bench_ItemInvoiceAmount   ON invoice_items(InvoiceId, UnitPrice, Quantity)'
+    ,   'IX_Bench_ItemTrackAmount'      : 'CREATE INDEX IX_Bench_ItemTrackAmount     ON invoice_items(TrackId, UnitPrice, Quantity)'
+    }
+    
+    def __init__(self, dbfile, repeat, evaluate_indexes, keep_indexes, min_speedup):
+        assert dbfile.endswith('.db')
+        assert os.path.exists(dbfile)
+        assert repeat > 0
+        self.dbfile             = dbfile
+        self.repeat             = repeat
+        self.evaluate_indexes   = evaluate_indexes
+        self.keep_indexes       = keep_indexes
+        self.min_speedup        = min_speedup
+    
+    def connect(self):
+        if self.evaluate_indexes:
+            return sqlite3.connect(self.dbfile)
+        uri = 'file:' + os.path.abspath(self.dbfile) + '?mode=ro'
+        return sqlite3.connect(uri, uri=True)
+    
+    def time_query(self, conn, name, sql):
+        plan = [ row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql) ]
+        # untimed warm-up, so the baseline pass does not pay for the page cache the indexed pass reuses
+        conn.execute(sql).fetchall()
+        times = []
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            conn.execute(sql).fetchall()
+            times.append(time.perf_counter() - start)
+        return QueryTiming(name, times, plan)
+    
+    def run_queries(self, conn):
+        timings = {}
+        invoices = Db.invoices_relation(conn)
+        for name, sql in self.QUERIES.items():
+            timings[name] = self.time_query(conn, name, sql.format(invoices=invoices))
+            info(f'{name} - median {timings[name].median * 1000.0:.2f} ms')
+        return timings
+    
+    def create_indexes(self, conn):
+        build_times = {}
+        for name, sql in self.CANDIDATE_INDEXES.items():
+            start = time.perf_counter()
+            try:
+                conn.execute(sql)
+            except sqlite3.OperationalError as e:
+                # LocationId only exists in compact DBs
+                if 'no such column' not in str(e):
+                    raise
+                info(f'skipping {name}: {e}')
+                continue
+            build_times[name] = time.perf_counter() - start
+        conn.commit()
+        return build_times
+    
+    def drop_indexes(self, conn):
+        for name in self.CANDIDATE_INDEXES:
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+        conn.commit()
+    
+    def recommend(self, baseline, indexed):
+        recommended = {}
+        for name in self.CANDIDATE_INDEXES:
+            for query, timing in indexed.items():
+                speedup = baseline[query].median / max(timing.median, 1e-9)
+                if timing.uses(name) and speedup >= self.min_speedup:
+                    recommended.setdefault(name, []).append(query)
+        return recommended
+    
+    def report_plan(self, timing):
+        for line in timing.plan:
+            print(f'        {line}')
+    
+    def report(self, baseline, indexed, build_times, recommended):
+        for name, timing in baseline.items():
+            ms = [ t * 1000.0 for t in timing.times ]
+            line = f'QUERY - {name:<20} - min {min(ms):9.2f} ms - median {timing.median * 1000.0:9.2f} ms - max {max(ms):9.2f} ms'
+            if indexed:
+                speedup = timing.median / max(indexed[name].median, 1e-9)
+                line += f' - indexed median {indexed[name].median * 1000.0:9.2f} ms ({speedup:.2f}x)'
+            print(line)
+            self.report_plan(timing)
+            if indexed:
+                print('    with candidate indexes:')
+                self.report_plan(indexed[name])
+        for name, elapsed in build_times.items():
+            queries = recommended.get(name)
+            verdict = 'RECOMMENDED for ' + ', '.join(queries) if queries else 'not useful'
+            print(f'INDEX - {name:<28} - built in {elapsed * 1000.0:9.2f} ms - {verdict}')
+    
+    def run(self):
+        info(f'benchmarking {self.dbfile} with {self.repeat} runs per query')
+        conn = self.connect()
+        if self.evaluate_indexes:
+            # candidates kept by an earlier run would skew the baseline and fail to build
+            self.drop_indexes(conn)
+        baseline = self.run_queries(conn)
+        indexed, build_times, recommended = {}, {}, {}
+        if self.evaluate_indexes:
+            info('creating candidate indexes')
+            build_times = self.create_indexes(conn)
+            indexed = self.run_queries(conn)
+            recommended = self.recommend(baseline, indexed)
+            if not self.keep_indexes:
+                self.drop_indexes(conn)
+        conn.close()
+        self.report(baseline, indexed, build_times, recommended)
+        info('finished')
+
+# catalog loaded once by each service worker process
+_worker_catalog = None
+
+def _init_service_worker(in_db):
+    global _worker_catalog
+    _worker_catalog = Catalog.from_db(Db(in_db))
+
+def _run_service_job(in_db, job):
+    start = time.perf_counter()
+    app = App(
+        in_db
+    ,   job['out_db']
+    ,   job['num_customers']
+    ,   dt.date.fromisoformat(job['start_date'])
+    ,   dt.date.fromisoformat(job['end_date'])
+    ,   engine          = job.get('engine', ReferenceEngine.NAME)
+    ,   seed            = job.get('seed')
+    ,   popularity      = job.get('popularity', 'uniform')
+    ,   zipf_exponent   = job.get('zipf_exponent', 1.0)
+    ,   compact         = job.get('compact', False)
+    ,   lazy_customers  = job.get('lazy_customers', False)
+    )
+    app.run(catalog=_worker_catalog)
+    elapsed = time.perf_counter() - start
+    return {
+        'seed'              : app.seed
+    ,   'customers'         : app.num_customers
+    ,   'invoices'          : app.invoice_count
+    ,   'elapsed'           : elapsed
+    ,   'invoices_per_sec'  : app.invoice_count / max(elapsed, 1e-9)
+    ,   'timings'           : app.timings
+    }
+
+class Service(object):
+    
+    # reads one JSON job per line from the input stream and writes one JSON result per line as jobs finish
+    
+    def __init__(self, in_db, workers, jobs_in, results_out):
+        assert in_db.endswith('.db')
+        assert os.path.exists(in_db)
+        assert workers > 0
+        self.in_db          = in_db
+        self.workers        = workers
+        self.jobs_in        = jobs_in
+        self.results_out    = results_out
+        self.lock           = threading.Lock()
+        self.failures       = 0
+    
+    def emit(self, result):
+        with self.lock:
+            if result['status'] != 'ok':
+                self.failures += 1
+            print(json.dumps(result), file=self.results_out, flush=True)
+    
+    def on_done(self, job_id, future):
+        try:
+            result = { 'id': job_id, 'status': 'ok' }
+            result.update(future.result())
+        except Exception as e:
+            result = { 'id': job_id, 'status': 'error', 'error': f'{type(e).__name__}: {e}' }
+        self.emit(result)
+    
+    @staticmethod
+    def is_int(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+    
+    @staticmethod
+    def parse_date(job, field):
+        value = job[field]
+        try:
+            return dt.date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{field} {value!r} must be an ISO date (YYYY-MM-DD)') from None
+    
+    def parse_job(self, line, line_no):
+        job = json.loads(line)
+        if not isinstance(job, dict):
+            raise ValueError(f'expected a JSON object, got {type(job).__name__}')
+        for field in ('out_db', 'num_customers', 'start_date', 'end_date'):
+            if field not in job:
+                raise ValueError(f'missing field {field}')
+        out_db = job['out_db']
+        if not isinstance(out_db, str) or not out_db.endswith('.db'):
+            raise ValueError(f'out_db {out_db!r} must be a path ending in .db')
+        if os.path.abspath(out_db) == os.path.abspath(self.in_db):
+            raise ValueError(f'out_db {out_db!r} must differ from the input DB')
+        if not self.is_int(job['num_customers']) or job['num_customers'] <= 0:
+            raise ValueError(f'num_customers {job["num_customers"]!r} must be a positive integer')
+        if job.get('seed') is not None and not self.is_int(job['seed']):
+            raise ValueError(f'seed {job["seed"]!r} must be an integer')
+        zipf_exponent = job.get('zipf_exponent', 1.0)
+        if isinstance(zipf_exponent, bool) or not isinstance(zipf_exponent, (int, float)) or zipf_exponent <= 0:
+            raise ValueError(f'zipf_exponent {zipf_exponent!r} must be a positive number')
+        start_date = self.parse_date(job, 'start_date')
+        end_date = self.parse_date(job, 'end_date')
+        if start_date >= end_date:
+            raise ValueError(f'start_date {job["start_date"]} must be before end_date {job["end_date"]}')
+        engine = job.get('engine', ReferenceEngine.NAME)
+        if engine not in App.ENGINES:
+            raise ValueError(f'unknown engine {engine!r}, expected one of {", ".join(App.ENGINES)}')
+        popularity = job.get('popularity', 'uniform')
+        if popularity not in State.POPULARITY_MODELS:
+            raise ValueError(f'unknown popularity {popularity!r}, expected one of {", ".join(State.POPULARITY_MODELS)}')
+        job.setdefault('id', line_no)
+        return job
+    
+    def run(self):
+        info(f'starting service for {self.in_db} with {self.workers} workers')
+        with ProcessPoolExecutor(self.workers, initializer=_init_service_worker, initargs=(self.in_db,)) as executor:
+            for line_no, line in enumerate(self.jobs_in, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    job = self.parse_job(line, line_no)
+                except ValueError as e:
+                    self.emit({ 'id': line_no, 'status': 'error', 'error': f'invalid job: {e}' })
+                    continue
+                future = executor.submit(_run_service_job, self.in_db, job)
+                future.add_done_callback(lambda f, job_id=job['id']: self.on_done(job_id, f))
+        info('finished')
+        return self.failures == 0
+
+def generate_main(argv):
     parser = argparse.ArgumentParser()
     date_type = dt.date.fromisoformat
     parser.add_argument('in_db',         type=str,       help='input OLTP DB')
@@ -868,13 +2504,130 @@ if __name__ == '__main__':
     parser.add_argument('num_customers', type=int,       help='number of customers')
     parser.add_argument('start_date',    type=date_type, help='start date')
     parser.add_argument('end_date',      type=date_type, help='end date')
-    args = parser.parse_args()
+    parser.add_argument('--engine',      type=str, default=ReferenceEngine.NAME, choices=sorted(App.ENGINES), help='invoice generation engine')
+    parser.add_argument('--seed',        type=int, default=None, help='random seed (a fresh one is drawn and logged when omitted)')
+    parser.add_argument('--popularity',  type=str, default='uniform', choices=State.POPULARITY_MODELS, help='track popularity model within each genre')
+    parser.add_argument('--zipf-exponent', type=float, default=1.0, help='exponent of the zipf popularity model')
+    parser.add_argument('--compact',     action='store_true', help='store location ids instead of address strings, with customers_v/invoices_v compatibility views')
+    parser.add_argument('--lazy-customers', action='store_true', help='derive customers from the seed on demand instead of keeping all of them in memory')
+    trickle = parser.add_argument_group('trickle mode', 'write invoices in real time while other processes read the output DB')
+    pacing = trickle.add_mutually_exclusive_group()
+    pacing.add_argument('--trickle-rate',        type=float, default=None, help='target invoices per second')
+    pacing.add_argument('--trickle-compression', type=float, default=None, help='simulated seconds per wall clock second')
+    trickle.add_argument('--trickle-max-txn-invoices', type=int, default=50, help='maximum invoices per write transaction')
+    trickle.add_argument('--trickle-max-txn-ms', type=float, default=100.0, help='maximum write transaction age in milliseconds')
+    trickle.add_argument('--trickle-journal-mode', type=str, default='wal', choices=TrickleOptions.JOURNAL_MODES, help='journal mode of the output DB')
+    trickle.add_argument('--trickle-probe-interval', type=float, default=0.0, help='poll the output DB every so many seconds from a reader thread (0 disables)')
+    args = parser.parse_args(argv)
+    trickle_options = None
+    if args.trickle_rate is not None or args.trickle_compression is not None:
+        trickle_options = TrickleOptions(
+            rate                = args.trickle_rate
+        ,   time_compression    = args.trickle_compression
+        ,   max_txn_invoices    = args.trickle_max_txn_invoices
+        ,   max_txn_ms          = args.trickle_max_txn_ms
+        ,   journal_mode        = args.trickle_journal_mode
+        ,   probe_interval      = args.trickle_probe_interval
+        )
     app = App(
         args.in_db
     ,   args.out_db
     ,   args.num_customers
     ,   args.start_date
     ,   args.end_date
+    ,   engine          = args.engine
+    ,   seed            = args.seed
+    ,   popularity      = args.popularity
+    ,   zipf_exponent   = args.zipf_exponent
+    ,   trickle         = trickle_options
+    ,   compact         = args.compact
+    ,   lazy_customers  = args.lazy_customers
     )
     app.run()
-    
\ No newline at end of file
+    return 0
+
+def verify_main(argv):
+    parser = argparse.ArgumentParser(prog='generate_invoices.py verify')
+    cpu_count = os.cpu_count() or 1
+    parser.add_argument('db',           type=str,                   help='generated OLTP DB')
+    parser.add_argument('--partitions', type=int, default=cpu_count, help='number of invoice and customer id range partitions')
+    parser.add_argument('--workers',    type=int, default=cpu_count, help='number of parallel read-only connections')
+    parser.add_argument('--create-index', action='store_true',      help='add an index on invoices(InvoiceDate) to the DB before checking it')
+    args = parser.parse_args(argv)
+    verifier = Verifier(
+        args.db
+    ,   args.partitions
+    ,   args.workers
+    ,   create_index = args.create_index
+    )
+    ok = verifier.run()
+    return 0 if ok else 1
+
+def compare_main(argv):
+    parser = argparse.ArgumentParser(prog='generate_invoices.py compare')
+    date_type = dt.date.fromisoformat
+    engines = sorted(App.ENGINES)
+    parser.add_argument('in_db',         type=str,       help='input OLTP DB')
+    parser.add_argument('out_dir',       type=str,       help='directory for the generated DBs')
+    parser.add_argument('num_customers', type=int,       help='number of customers')
+    parser.add_argument('start_date',    type=date_type, help='start date')
+    parser.add_argument('end_date',      type=date_type, help='end date')
+    parser.add_argument('--reference',   type=str, default=ReferenceEngine.NAME, choices=engines, help='reference engine')
+    parser.add_argument('--candidate',   type=str, default=ReferenceEngine.NAME, choices=engines, help='candidate engine')
+    parser.add_argument('--seed',        type=int, default=None, help='random seed shared by both engines')
+    args = parser.parse_args(argv)
+    harness = Harness(
+        args.in_db
+    ,   args.out_dir
+    ,   args.num_customers
+    ,   args.start_date
+    ,   args.end_date
+    ,   args.reference
+    ,   args.candidate
+    ,   seed = args.seed
+    )
+    ok = harness.run()
+    return 0 if ok else 1
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(prog='generate_invoices.py serve')
+    cpu_count = os.cpu_count() or 1
+    parser.add_argument('in_db',     type=str,                    help='input OLTP DB')
+    parser.add_argument('--workers', type=int, default=cpu_count, help='number of worker processes')
+    args = parser.parse_args(argv)
+    service = Service(args.in_db, args.workers, sys.stdin, sys.stdout)
+    ok = service.run()
+    return 0 if ok else 1
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(prog='generate_invoices.py bench')
+    parser.add_argument('db',               type=str,                   help='generated OLTP DB')
+    parser.add_argument('--repeat',         type=int,   default=5,      help='runs per query')
+    parser.add_argument('--indexes',        action='store_true',        help='create and evaluate the candidate covering indexes')
+    parser.add_argument('--keep-indexes',   action='store_true',        help='keep the candidate indexes after the benchmark')
+    parser.add_argument('--min-speedup',    type=float, default=1.2,    help='median speedup needed to recommend an index')
+    args = parser.parse_args(argv)
+    benchmark = Benchmark(
+        args.db
+    ,   args.repeat
+    ,   args.indexes
+    ,   args.keep_indexes
+    ,   args.min_speedup
+    )
+    benchmark.run()
+    return 0
+
+COMMANDS = {
+    'verify'  : verify_main
+,   'compare' : compare_main
+,   'serve'   : serve_main
+,   'bench'   : bench_main
+}
+
+def main(argv):
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return generate_main(argv)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))